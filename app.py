@@ -1,281 +1,324 @@
-import os
-import json
-from datetime import datetime
-from flask import Flask, request, jsonify
-from openai import OpenAI
-
-app = Flask(__name__)
-
-# OpenAI client (new SDK)
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-# Optional: simple shared secret so only your script can call this
-INCOMING_API_KEY = os.getenv("INCOMING_API_KEY", "")
-
-# Global "Dave" system prompt
-BASE_SYSTEM_PROMPT = (
-    "You are Daver AI Clone, a digital assistant for David Reimers, "
-    "a Greater Vancouver residential realtor focused on Coquitlam. "
-    "Write short, professional replies in Dave's voice. No emojis. "
-    "No flowery marketing language. Be clear, calm, and helpful. "
-    "Use plain ASCII punctuation (no curly quotes, no smart quotes, no ellipsis character)."
-)
-
-# Instructions for the lead-extraction style task
-JSON_INSTRUCTIONS = """
-Return ONLY valid JSON with this exact structure:
-{
-  "name": string | null,
-  "email": string | null,
-  "phone": string | null,
-  "lead_type": "Buyer" | "Seller" | "Foreclosure" | "VIPMA" | "Home Evaluation" | "Other",
-  "priority": "High" | "Medium" | "Low",
-  "summary": string,
-  "reply": string
-}
-The reply should NOT include David's full email signature block. End with a natural closing like "Cheers, David".
-Do not include any extra keys or prose. Only JSON.
-"""
-
-
-def call_openai(messages, model="gpt-4o", temperature=0.2):
-    """Small helper so we only write the OpenAI call once."""
-    resp = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=temperature,
-    )
-    return resp.choices[0].message.content
-
-
-def normalize_punctuation(text: str) -> str:
-    """
-    Convert common smart punctuation to plain ASCII.
-    We do NOT strip all non-ASCII (to avoid breaking names), just the usual suspects.
-    """
-    if not isinstance(text, str):
-        return text
-
-    replacements = {
-        "“": '"',
-        "”": '"',
-        "„": '"',
-        "«": '"',
-        "»": '"',
-        "‘": "'",
-        "’": "'",
-        "‚": "'",
-        "–": "-",
-        "—": "-",
-        "−": "-",
-        "…": "...",
-        "\u00a0": " ",  # non-breaking space
-    }
-    for bad, good in replacements.items():
-        text = text.replace(bad, good)
-    return text
-
-
-def handle_gmail_lead_reply(email_text: str) -> dict:
-    """
-    Extract lead details and write a reply in Dave's style.
-    Returns a dict matching JSON_INSTRUCTIONS.
-    """
-    user_prompt = f"""
-Extract lead details from this email and write a reply in Dave's style.
-
-{JSON_INSTRUCTIONS}
-
-Email content:
-\"\"\" 
-{email_text}
-\"\"\" 
-"""
-
-    try:
-        content = call_openai(
-            messages=[
-                {"role": "system", "content": BASE_SYSTEM_PROMPT},
-                {"role": "user", "content": user_prompt},
-            ]
-        )
-    except Exception as e:
-        # If OpenAI call fails, we still return a minimal structure
-        fallback_reply = (
-            "Hi there,\n\n"
-            "Thanks for reaching out. I saw your note and will follow up shortly.\n\n"
-            "Cheers,\n"
-            "David"
-        )
-        return {
-            "name": None,
-            "email": None,
-            "phone": None,
-            "lead_type": "Other",
-            "priority": "Medium",
-            "summary": email_text[:500],
-            "reply": fallback_reply,
-            "error": f"openai_error: {str(e)}",
-        }
-
-    # Try to parse JSON. If it fails, fall back to a basic reply-only payload.
-    try:
-        parsed = json.loads(content)
-    except Exception:
-        parsed = {
-            "name": None,
-            "email": None,
-            "phone": None,
-            "lead_type": "Other",
-            "priority": "Medium",
-            "summary": email_text[:500],
-            "reply": content,
-        }
-
-    # Ensure all expected keys exist
-    for key, default in [
-        ("name", None),
-        ("email", None),
-        ("phone", None),
-        ("lead_type", "Other"),
-        ("priority", "Medium"),
-        ("summary", email_text[:500]),
-        ("reply", ""),
-    ]:
-        if key not in parsed:
-            parsed[key] = default
-
-    # Normalize punctuation on text fields
-    for k in ["name", "email", "phone", "summary", "reply"]:
-        if parsed.get(k):
-            parsed[k] = normalize_punctuation(parsed[k])
-
-    return parsed
-
-
-def build_reply_html_from_result(result: dict) -> str:
-    """
-    Take the GPT result dict and build final HTML reply, with:
-    - normalized ASCII punctuation
-    - default HTML signature appended
-    """
-    reply_text = normalize_punctuation(result.get("reply") or "")
-
-    if reply_text:
-        # Split into paragraphs on double newlines
-        parts = [p.strip() for p in reply_text.split("\n\n") if p.strip()]
-        if len(parts) > 1:
-            body_html = "<p>" + "</p><p>".join(
-                p.replace("\n", "<br>") for p in parts
-            ) + "</p>"
-        else:
-            body_html = "<p>" + reply_text.replace("\n", "<br>") + "</p>"
-    else:
-        body_html = "<p>Hi there,</p><p>Thanks for your message. I will review it and follow up with next steps.</p>"
-
-    # Default HTML signature (ASCII-friendly)
-    signature_html = """
-<p>Cheers,<br>
-David Reimers PREC*<br>
-Royal LePage West Real Estate Services<br>
-604-340-9822<br>
-<a href="https://reimers.ca">reimers.ca</a></p>
-""".strip()
-
-    full_html = f"{body_html}\n{signature_html}"
-    return full_html
-
-
-@app.route("/lead", methods=["POST"])
-def lead_endpoint():
-    """
-    Endpoint used by the Gmail Apps Script.
-
-    - Accepts payload with body/body_text, from_name, from_email, subject, etc.
-    - Uses the Daver AI Clone GPT logic (handle_gmail_lead_reply) to generate a reply.
-    - Returns JSON containing parsed lead info + reply_html (with default signature).
-    """
-    # Optional auth
-    if INCOMING_API_KEY and request.headers.get("X-API-Key") != INCOMING_API_KEY:
-        return jsonify({"error": "unauthorized"}), 401
-
-    data = request.get_json(silent=True) or {}
-
-    # Accept either "body" or "body_text" from Apps Script
-    body = data.get("body") or data.get("body_text") or ""
-    body = (body or "").strip()
-
-    if not body:
-        return jsonify({"error": "missing 'body' or 'body_text' in JSON"}), 400
-
-    from_name = data.get("from_name") or "there"
-    from_email = data.get("from_email")
-    subject = data.get("subject") or ""
-    phone = data.get("phone")
-    source = data.get("source") or "gmail"
-
-    # Use your Daver AI Clone GPT JSON template
-    result = handle_gmail_lead_reply(body)
-
-    # Prefer explicit metadata if GPT left these blank
-    result_name = result.get("name") or from_name
-    result_email = result.get("email") or None  # let Apps Script choose fallback
-    result_phone = result.get("phone") or phone
-
-    reply_html = build_reply_html_from_result(result)
-
-    result["name"] = result_name
-    result["email"] = result_email
-    result["phone"] = result_phone
-    result["reply_html"] = reply_html
-    result["source"] = source
-
-    print("Lead endpoint processed:", json.dumps(result, ensure_ascii=False)[:800])
-    return jsonify(result), 200
-
-
-@app.route("/", methods=["POST"])
-def process_lead_or_task():
-    """
-    Backwards-compatible root endpoint (still available if you ever use it).
-    """
-    if INCOMING_API_KEY and request.headers.get("X-API-Key") != INCOMING_API_KEY:
-        return jsonify({"error": "unauthorized"}), 401
-
-    data = request.get_json(silent=True) or {}
-
-    body = data.get("body") or data.get("body_text") or ""
-    body = (body or "").strip()
-
-    if not body:
-        return jsonify({"error": "missing 'body' or 'body_text' in JSON"}), 400
-
-    result = handle_gmail_lead_reply(body)
-
-    out = {
-        "timestamp": datetime.utcnow().isoformat(),
-        "task_type": "gmail_lead_reply",
-        "input_preview": body[:500],
-        "meta": {
-            "from_name": data.get("from_name"),
-            "from_email": data.get("from_email"),
-            "subject": data.get("subject"),
-            "phone": data.get("phone"),
-            "source": data.get("source"),
-        },
-        "result": result,
-    }
-
-    print("Processed /:", json.dumps(out, ensure_ascii=False)[:1000])
-    return jsonify(out), 200
-
-
-@app.route("/health", methods=["GET"])
-def health():
-    return jsonify({"ok": True, "time": datetime.utcnow().isoformat()}), 200
-
-
-# Render/Flask entrypoint
-if __name__ == "__main__":
-    port = int(os.environ.get("PORT", "10000"))
-    app.run(host="0.0.0.0", port=port)
+import os
+import time
+import sys
+import atexit
+import queue
+import asyncio
+import hmac
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timezone
+import orjson
+from quart import Quart, Response, request, jsonify
+from quart.json.provider import DefaultJSONProvider
+
+from dave_core import (
+    build_reply_html_from_result,
+    close_http_client,
+    detect_lead_type,
+    exceeds_input_limit,
+    fetch_lead_batch,
+    handle_gmail_lead_reply,
+    lead_batcher,
+    llm_cache,
+    stream_reply,
+    submit_lead_batch,
+    try_rules_based_result,
+)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Route request.get_json() and jsonify() through orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype=self.mimetype)
+
+
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
+
+# Logging: the request path only enqueues records; a background thread
+# does the formatting and the (possibly back-pressured) stdout write.
+_log_queue = queue.Queue(-1)
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(
+    logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s")
+)
+_log_listener = QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logging.getLogger().addHandler(QueueHandler(_log_queue))
+logging.getLogger().setLevel(logging.INFO)
+# Fixed name: __name__ is "__main__" or "app" depending on how we're served
+logger = logging.getLogger("daver")
+
+# Optional: simple shared secret so only your script can call this
+INCOMING_API_KEY = os.getenv("INCOMING_API_KEY", "")
+_AUTH_ENABLED = bool(INCOMING_API_KEY)
+# Compared as bytes: compare_digest rejects non-ASCII str input
+_API_KEY_BYTES = INCOMING_API_KEY.encode()
+
+
+@app.before_serving
+async def start_lead_batcher():
+    lead_batcher.start()
+
+
+@app.after_serving
+async def shutdown_worker():
+    await lead_batcher.stop()
+    await close_http_client()
+
+
+def is_authorized() -> bool:
+    """Optional auth: callers must send the shared secret when one is configured."""
+    if not _AUTH_ENABLED:
+        return True
+    supplied = request.headers.get("X-API-Key", "").encode()
+    # Constant-time, so response timing doesn't leak how much of the key matched
+    return hmac.compare_digest(supplied, _API_KEY_BYTES)
+
+
+async def read_lead_request():
+    """
+    Shared auth + payload parsing for the lead routes.
+    Returns (data, body, None) on success, or (None, None, error_response).
+    """
+    if not is_authorized():
+        return None, None, (jsonify({"error": "unauthorized"}), 401)
+
+    data = await request.get_json(silent=True) or {}
+
+    # Accept either "body" or "body_text" from Apps Script
+    body = (data.get("body") or data.get("body_text") or "").strip()
+    if not body:
+        return None, None, (
+            jsonify({"error": "missing 'body' or 'body_text' in JSON"}),
+            400,
+        )
+    if await exceeds_input_limit(body):
+        return None, None, (jsonify({"error": "body too large"}), 413)
+
+    return data, body, None
+
+
+@app.route("/lead", methods=["POST"])
+async def lead_endpoint():
+    """
+    Endpoint used by the Gmail Apps Script.
+
+    - Accepts payload with body/body_text, from_name, from_email, subject, etc.
+    - Uses the Daver AI Clone GPT logic (handle_gmail_lead_reply) to generate a reply.
+    - Returns JSON containing parsed lead info + reply_html (with default signature).
+    - With "batch": true, queues the lead on the Batch API instead and returns
+      202 with a batch_id to poll at /batch/<batch_id>.
+    """
+    data, body, error = await read_lead_request()
+    if error:
+        return error
+
+    from_name = data.get("from_name") or "there"
+    from_email = data.get("from_email")
+    subject = data.get("subject") or ""
+    phone = data.get("phone")
+    source = data.get("source") or "gmail"
+    form_name = data.get("form_name") or ""
+
+    # Known structured forms are answered from rules; everything else goes to GPT
+    result = try_rules_based_result(data, subject, body)
+
+    # Keyword routing backs up the model's lead_type on both GPT paths
+    lead_type_hint = None
+    if result is None:
+        lead_type_hint = detect_lead_type(subject, body, form_name)
+
+    # Opt-in: non-urgent leads go through the Batch API at half the cost
+    if result is None and data.get("batch"):
+        try:
+            queued = await submit_lead_batch(body, lead_type_hint=lead_type_hint)
+        except Exception as e:
+            return jsonify({"error": f"openai_error: {str(e)}"}), 502
+        return jsonify(queued), 202
+
+    if result is None:
+        # Use your Daver AI Clone GPT JSON template
+        result = await handle_gmail_lead_reply(
+            body,
+            preview=body[:500],
+            sender_name=data.get("from_name"),
+            lead_type_hint=lead_type_hint,
+        )
+
+    # Prefer explicit metadata if GPT left these blank
+    result_name = result.get("name") or from_name
+    result_email = result.get("email") or None  # let Apps Script choose fallback
+    result_phone = result.get("phone") or phone
+
+    reply_html = build_reply_html_from_result(result)
+
+    result["name"] = result_name
+    result["email"] = result_email
+    result["phone"] = result_phone
+    result["reply_html"] = reply_html
+    result["source"] = source
+
+    # key=value fields instead of the serialized payload: cheap to format, easy to grep
+    logger.info(
+        "processed route=/lead lead_type=%s source=%s error=%s preview=%r",
+        result.get("lead_type"),
+        source,
+        result.get("error"),
+        body[:200],
+    )
+    return jsonify(result), 200
+
+
+@app.route("/batch/<batch_id>", methods=["GET"])
+async def batch_status(batch_id):
+    """
+    Poll a lead queued with "batch": true. Returns the status, plus the parsed
+    lead (with reply_html) once the batch has completed.
+    """
+    if not is_authorized():
+        return jsonify({"error": "unauthorized"}), 401
+
+    try:
+        out = await fetch_lead_batch(batch_id)
+    except Exception as e:
+        return jsonify({"error": f"openai_error: {str(e)}"}), 502
+    if out is None:
+        return jsonify({"error": "unknown batch"}), 404
+
+    if "result" in out:
+        out["result"]["reply_html"] = build_reply_html_from_result(out["result"])
+    return jsonify(out), 200
+
+
+@app.route("/", methods=["POST"])
+async def process_lead_or_task():
+    """
+    Backwards-compatible root endpoint (still available if you ever use it).
+    """
+    data, body, error = await read_lead_request()
+    if error:
+        return error
+
+    # Callers can escalate to a specific model (e.g. "gpt-4o") when needed
+    model = data.get("model") if isinstance(data.get("model"), str) else None
+    preview = body[:500]
+    # Same keyword routing as /lead backs up the model's lead_type
+    lead_type_hint = detect_lead_type(
+        data.get("subject") or "", body, data.get("form_name") or ""
+    )
+    result = await handle_gmail_lead_reply(
+        body,
+        model=model,
+        preview=preview,
+        sender_name=data.get("from_name"),
+        lead_type_hint=lead_type_hint,
+    )
+
+    out = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "task_type": "gmail_lead_reply",
+        "input_preview": preview,
+        "meta": {
+            "from_name": data.get("from_name"),
+            "from_email": data.get("from_email"),
+            "subject": data.get("subject"),
+            "phone": data.get("phone"),
+            "source": data.get("source"),
+        },
+        "result": result,
+    }
+
+    logger.info(
+        "processed route=/ task_type=%s lead_type=%s error=%s preview=%r",
+        out["task_type"],
+        result.get("lead_type"),
+        result.get("error"),
+        preview[:200],
+    )
+    return jsonify(out), 200
+
+
+def sse_frame(text: str, event=None) -> str:
+    """One server-sent event; embedded newlines become extra data: lines."""
+    frame = "data: " + text.replace("\n", "\ndata: ") + "\n\n"
+    return f"event: {event}\n{frame}" if event else frame
+
+
+@app.route("/stream", methods=["POST"])
+async def stream_endpoint():
+    """
+    Streams a plain reply as server-sent events, one data: frame per token,
+    ending with "data: [DONE]". Lead extraction (task_type
+    "gmail_lead_reply") returns structured JSON and can't stream; use /lead.
+    """
+    data, body, error = await read_lead_request()
+    if error:
+        return error
+
+    if data.get("task_type") == "gmail_lead_reply":
+        return jsonify(
+            {"error": "gmail_lead_reply is not streamable; use /lead or /"}
+        ), 400
+
+    model = data.get("model") if isinstance(data.get("model"), str) else None
+
+    async def events():
+        try:
+            async for token in stream_reply(body, model=model):
+                yield sse_frame(token)
+        except Exception as e:
+            logger.warning("Stream failed: %s", e)
+            yield sse_frame(f"openai_error: {str(e)}", event="error")
+            return
+        yield sse_frame("[DONE]")
+
+    return Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+# Load balancers poll /health constantly; the formatted time only changes
+# once a second, so reuse it: [epoch seconds, isoformat string]
+_HEALTH_CACHE = [0.0, ""]
+
+
+@app.route("/health", methods=["GET"])
+async def health():
+    now = time.time()
+    if now - _HEALTH_CACHE[0] >= 1.0:
+        _HEALTH_CACHE[:] = [
+            now,
+            datetime.fromtimestamp(now, tz=timezone.utc).isoformat(),
+        ]
+    return jsonify(
+        {
+            "ok": True,
+            "time": _HEALTH_CACHE[1],
+            "llm_cache": llm_cache.stats(),
+        }
+    ), 200
+
+
+# Local dev entrypoint (served by Hypercorn).
+# Production runs via the Procfile: gunicorn with uvicorn ASGI workers.
+if __name__ == "__main__":
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config
+
+    port = int(os.environ.get("PORT", "10000"))
+    config = Config()
+    config.bind = [f"0.0.0.0:{port}"]
+    asyncio.run(serve(app, config))
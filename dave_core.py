@@ -0,0 +1,1393 @@
+"""
+Shared lead-processing logic for the Daver AI Clone service: prompts, the
+OpenAI client, caches, batching and reply HTML. app.py only wires routes.
+"""
+import os
+import re
+import asyncio
+import time
+import hashlib
+import html
+import logging
+import uuid
+from collections import OrderedDict
+from functools import lru_cache
+import httpx
+import orjson
+from jinja2 import Template
+from openai import (
+    AsyncOpenAI,
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    RateLimitError,
+)
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+logger = logging.getLogger(__name__)
+
+# Async OpenAI client (new SDK). One httpx pool per process so keepalive
+# TCP+TLS connections are reused across requests, and HTTP/2 lets concurrent
+# completions multiplex over a single connection. SDK retries are off;
+# call_openai retries with backoff itself (see below).
+_http = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(
+        max_connections=200, max_keepalive_connections=100, keepalive_expiry=30
+    ),
+    timeout=httpx.Timeout(60.0, connect=5.0),
+)
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=0,
+    http_client=_http,
+)
+
+
+async def close_http_client():
+    """Close pooled keepalive connections cleanly when the worker shuts down."""
+    await _http.aclose()
+
+# Model for lead extraction + replies. gpt-4o-mini handles the fixed JSON
+# schema well at a fraction of gpt-4o's cost and latency.
+HANDLER_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+# Longer emails (forwarded threads, detailed inquiries) get the bigger model
+LONG_LEAD_MODEL = os.getenv("OPENAI_LONG_MODEL", "gpt-4o")
+LONG_LEAD_CHARS = int(os.getenv("LONG_LEAD_CHARS", "800"))
+
+
+def select_lead_model(email_text: str, override=None) -> str:
+    """Pick the model for a lead: caller override, else by email length."""
+    if override:
+        return override
+    return HANDLER_MODEL if len(email_text) < LONG_LEAD_CHARS else LONG_LEAD_MODEL
+
+
+class LocalSemanticCache:
+    """
+    In-process embedding-similarity cache for paraphrased leads, used when
+    Redis isn't configured. Same acheck/astore interface as redisvl's
+    SemanticCache. Vectors are unit-normalized and kept in a fixed-size numpy
+    ring buffer, so a lookup is one matrix-vector product and the oldest
+    entry is evicted once full.
+    """
+
+    def __init__(
+        self, threshold=0.95, max_entries=10000, model="text-embedding-3-small"
+    ):
+        import numpy
+
+        self._np = numpy
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.model = model
+        self._matrix = None
+        self._responses = [None] * max_entries
+        self._count = 0
+        self._next = 0
+
+    async def _unit_vector(self, prompt: str, vector=None):
+        if vector is None:
+            vector = await embed_text(prompt[:2000], model=self.model)
+        vec = self._np.asarray(vector, dtype=self._np.float32)
+        return vec / (self._np.linalg.norm(vec) or 1.0)
+
+    async def acheck(self, prompt: str = None, vector=None, num_results: int = 1):
+        vec = await self._unit_vector(prompt, vector)
+        if not self._count:
+            return []
+        scores = self._matrix[: self._count] @ vec
+        best = int(scores.argmax())
+        if scores[best] < self.threshold:
+            return []
+        return [{"response": self._responses[best], "score": float(scores[best])}]
+
+    async def astore(self, prompt: str, response: str, vector=None):
+        vec = await self._unit_vector(prompt, vector)
+        if self._matrix is None:
+            self._matrix = self._np.zeros(
+                (self.max_entries, vec.shape[0]), dtype=self._np.float32
+            )
+        self._matrix[self._next] = vec
+        self._responses[self._next] = response
+        self._next = (self._next + 1) % self.max_entries
+        self._count = min(self._count + 1, self.max_entries)
+
+
+# Optional: semantic cache for paraphrased leads.
+# - REDIS_URL set: Redis-backed (redisvl), cosine similarity >= 0.90 counts as a hit.
+# - LOCAL_SEMANTIC_CACHE=1: in-process numpy index, cosine similarity >= 0.95.
+REDIS_URL = os.getenv("REDIS_URL", "")
+semantic_cache = None
+if REDIS_URL:
+    from redisvl.extensions.cache.llm import SemanticCache
+    from redisvl.utils.vectorize import OpenAITextVectorizer
+
+    semantic_cache = SemanticCache(
+        name="dave_leads",
+        redis_url=REDIS_URL,
+        distance_threshold=0.10,
+        ttl=1800,
+        vectorizer=OpenAITextVectorizer(
+            model="text-embedding-3-small",
+            api_config={"api_key": os.getenv("OPENAI_API_KEY")},
+        ),
+    )
+elif os.getenv("LOCAL_SEMANTIC_CACHE"):
+    semantic_cache = LocalSemanticCache()
+
+# Global "Dave" system prompt
+BASE_SYSTEM_PROMPT = (
+    "You are Daver AI Clone, a digital assistant for David Reimers, "
+    "a Greater Vancouver residential realtor focused on Coquitlam. "
+    "Write short, professional replies in Dave's voice. No emojis. "
+    "No flowery marketing language. Be clear, calm, and helpful. "
+    "Use plain ASCII punctuation (no curly quotes, no smart quotes, no ellipsis character)."
+)
+
+# Instructions for the lead-extraction style task. Structured Outputs
+# (LEAD_SCHEMA below) enforce the shape; this tells the model what goes in it.
+JSON_INSTRUCTIONS = """
+Use this exact JSON structure for the lead:
+{
+  "name": string | null,
+  "email": string | null,
+  "phone": string | null,
+  "lead_type": "Buyer" | "Seller" | "Foreclosure" | "VIPMA" | "Home Evaluation" | "Other",
+  "priority": "High" | "Medium" | "Low",
+  "summary": string,
+  "reply": string
+}
+The reply should NOT include David's full email signature block. End with a natural closing like "Cheers, David".
+Do not include any extra keys.
+"""
+
+# Structured Outputs: the API guarantees every response matches this schema
+_LEAD_PROPERTIES = {
+    "name": {"type": ["string", "null"]},
+    "email": {"type": ["string", "null"]},
+    "phone": {"type": ["string", "null"]},
+    "lead_type": {
+        "type": "string",
+        "enum": ["Buyer", "Seller", "Foreclosure", "VIPMA", "Home Evaluation", "Other"],
+    },
+    "priority": {"type": "string", "enum": ["High", "Medium", "Low"]},
+    "summary": {"type": "string"},
+    "reply": {"type": "string"},
+}
+_LEAD_OBJECT = {
+    "type": "object",
+    "properties": _LEAD_PROPERTIES,
+    "required": list(_LEAD_PROPERTIES),
+    "additionalProperties": False,
+}
+LEAD_SCHEMA = {"name": "Lead", "strict": True, "schema": _LEAD_OBJECT}
+LEAD_BATCH_SCHEMA = {
+    "name": "LeadBatch",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {"leads": {"type": "array", "items": _LEAD_OBJECT}},
+        "required": ["leads"],
+        "additionalProperties": False,
+    },
+}
+LEAD_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": LEAD_SCHEMA}
+LEAD_BATCH_RESPONSE_FORMAT = {"type": "json_schema", "json_schema": LEAD_BATCH_SCHEMA}
+
+
+class LLMCache:
+    """
+    Small in-memory LRU + TTL cache for completions.
+    Keyed on a SHA-256 of (model, messages, temperature, response_format) so
+    byte-identical prompts (retries, duplicate form submissions) skip the
+    network.
+    An optional diskcache.Cache acts as a second tier that survives worker
+    restarts and is shared by every worker on the box. Its SQLite reads and
+    writes block (and may wait on other workers' locks), so they run in a
+    thread, off the event loop.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=1800, disk=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk = disk
+        self._store = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(model, messages, temperature, response_format=None) -> str:
+        raw = orjson.dumps(
+            {
+                "model": model,
+                "messages": messages,
+                "temperature": temperature,
+                "response_format": response_format,
+            },
+            option=orjson.OPT_SORT_KEYS,
+        )
+        return hashlib.sha256(raw).hexdigest()
+
+    async def get(self, model, messages, temperature, response_format=None):
+        key = self._key(model, messages, temperature, response_format)
+        entry = self._store.get(key)
+        if entry is not None:
+            content, stored_at = entry
+            if time.monotonic() - stored_at < self.ttl_seconds:
+                self._store.move_to_end(key)
+                self.hits += 1
+                return content
+            del self._store[key]
+
+        if self.disk is not None:
+            content = await asyncio.to_thread(self.disk.get, key)
+            if content is not None:
+                self.disk_hits += 1
+                self._remember(key, content)
+                return content
+
+        self.misses += 1
+        return None
+
+    async def set(self, model, messages, temperature, content, response_format=None):
+        key = self._key(model, messages, temperature, response_format)
+        self._remember(key, content)
+        if self.disk is not None:
+            await asyncio.to_thread(
+                self.disk.set, key, content, expire=self.ttl_seconds
+            )
+
+    def _remember(self, key, content):
+        self._store[key] = (content, time.monotonic())
+        self._store.move_to_end(key)
+        while len(self._store) > self.max_entries:
+            self._store.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self._store),
+        }
+
+
+# Optional: persistent outer cache tier (e.g. LLM_CACHE_DIR=/tmp/llmcache)
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "")
+_disk_cache = None
+if LLM_CACHE_DIR:
+    from diskcache import Cache
+
+    _disk_cache = Cache(LLM_CACHE_DIR)
+
+llm_cache = LLMCache(disk=_disk_cache)
+
+# Only cache near-deterministic completions
+CACHE_MAX_TEMPERATURE = 0.2
+
+
+# Optional: exact token counts with tiktoken. The BPE tables load once here;
+# if the package or its encoding file isn't available, use the ~4 chars per
+# token estimate instead.
+try:
+    import tiktoken
+
+    _TOKEN_ENC = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _TOKEN_ENC = None
+
+
+def estimate_tokens(text: str) -> int:
+    """Token count for text (o200k_base, or ~4 chars per token without tiktoken)."""
+    if _TOKEN_ENC is None:
+        return len(text) // 4 + 1
+    # encode_ordinary: user text that happens to contain "<|endoftext|>" is
+    # just text, not a reason to raise
+    return len(_TOKEN_ENC.encode_ordinary(text))
+
+
+# Inputs past this are rejected outright, before any trimming or model call
+MAX_INPUT_TOKENS = int(os.getenv("MAX_INPUT_TOKENS", "100000"))
+# Past this length even the ~4 chars per token estimate is over budget, so a
+# body this long is rejected without being encoded at all
+MAX_INPUT_CHARS = MAX_INPUT_TOKENS * 4
+
+
+async def exceeds_input_limit(text: str) -> bool:
+    """True if text is over MAX_INPUT_TOKENS."""
+    # No token spans less than one UTF-8 byte (at most 4 per char), so
+    # ordinary emails never need counting
+    if len(text) * 4 <= MAX_INPUT_TOKENS:
+        return False
+    if len(text) > MAX_INPUT_CHARS:
+        return True
+    # Encoding a few hundred KB takes milliseconds; keep it off the event loop
+    return await asyncio.to_thread(estimate_tokens, text) > MAX_INPUT_TOKENS
+
+
+class TokenBucket:
+    """
+    Proactive requests-per-minute + tokens-per-minute limiter.
+    Both budgets refill continuously; acquire() waits until the call fits
+    instead of letting OpenAI reject it with a 429.
+    """
+
+    def __init__(self, rpm, tpm):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, estimated_tokens: int):
+        estimated_tokens = min(estimated_tokens, self.tpm)
+        # One waiter at a time keeps callers FIFO
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= estimated_tokens:
+                    self._requests -= 1
+                    self._tokens -= estimated_tokens
+                    return
+                wait_requests = (1 - self._requests) * 60 / self.rpm
+                wait_tokens = (estimated_tokens - self._tokens) * 60 / self.tpm
+                await asyncio.sleep(max(wait_requests, wait_tokens, 0.01))
+
+    def release_extra(self, extra_tokens: int):
+        """Correct the token budget once actual usage is known (actual - estimate)."""
+        self._tokens = min(self.tpm, self._tokens - extra_tokens)
+
+
+# Set these to the account's real limits for the model in use
+rate_limiter = TokenBucket(
+    rpm=int(os.getenv("OPENAI_RPM", "500")),
+    tpm=int(os.getenv("OPENAI_TPM", "30000")),
+)
+
+# Cap on completions in flight per worker, so a burst queues here instead of
+# piling open streams onto the connection pool
+MAX_CONCURRENT_OPENAI = int(os.getenv("MAX_CONCURRENT_OPENAI", "20"))
+_openai_slots = asyncio.Semaphore(MAX_CONCURRENT_OPENAI)
+
+# Headroom reserved for the completion when estimating a call's tokens
+COMPLETION_TOKEN_ESTIMATE = 512
+
+
+def is_json_object(content: str) -> bool:
+    """True if content parses as a JSON object (the default cache check)."""
+    try:
+        return isinstance(orjson.loads(content), dict)
+    except orjson.JSONDecodeError:
+        return False
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    """Residual 429s, 5xx and connection hiccups are worth another try."""
+    if isinstance(exc, (RateLimitError, APIConnectionError, APITimeoutError)):
+        return True
+    return isinstance(exc, APIStatusError) and exc.status_code >= 500
+
+
+def _retrying() -> AsyncRetrying:
+    """Retry policy for every OpenAI call: jittered backoff, four attempts."""
+    return AsyncRetrying(
+        retry=retry_if_exception(_is_retryable),
+        wait=wait_random_exponential(min=1, max=20),
+        stop=stop_after_attempt(4),
+        reraise=True,
+    )
+
+
+def _estimate_call_tokens(messages) -> int:
+    """Token budget to reserve for a chat call: prompt plus completion headroom."""
+    prompt = sum(
+        _SYSTEM_TOKENS.get(m["content"]) or estimate_tokens(m["content"])
+        for m in messages
+    )
+    return prompt + COMPLETION_TOKEN_ESTIMATE
+
+
+async def call_openai(
+    messages,
+    model=HANDLER_MODEL,
+    temperature=0.2,
+    response_format=None,
+    validate=None,
+):
+    """
+    Small helper so we only write the OpenAI call once.
+    Content is only cached if the completion finished normally and
+    validate(content) is true; validate defaults to is_json_object when a
+    response_format is requested.
+    """
+    use_cache = temperature <= CACHE_MAX_TEMPERATURE
+    if use_cache:
+        cached = await llm_cache.get(model, messages, temperature, response_format)
+        if cached is not None:
+            return cached
+    if validate is None and response_format is not None:
+        validate = is_json_object
+
+    estimated = _estimate_call_tokens(messages)
+    async for attempt in _retrying():
+        with attempt:
+            async with _openai_slots:
+                await rate_limiter.acquire(estimated)
+                kwargs = {}
+                if response_format is not None:
+                    kwargs["response_format"] = response_format
+                # Stream so the first bytes (and any failure) show up right away;
+                # the content is assembled here and parsed once by the caller.
+                stream = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    **kwargs,
+                )
+                parts = []
+                usage = None
+                finish_reason = None
+                async for chunk in stream:
+                    if chunk.choices:
+                        choice = chunk.choices[0]
+                        if choice.delta.content:
+                            parts.append(choice.delta.content)
+                        if choice.finish_reason:
+                            finish_reason = choice.finish_reason
+                    # With include_usage, the last chunk carries usage and no choices
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+
+    if usage is not None:
+        rate_limiter.release_extra(usage.total_tokens - estimated)
+        details = getattr(usage, "prompt_tokens_details", None)
+        if details is not None:
+            logger.debug(
+                "OpenAI usage: prompt=%s cached=%s completion=%s",
+                usage.prompt_tokens,
+                details.cached_tokens,
+                usage.completion_tokens,
+            )
+    content = "".join(parts)
+
+    # Truncated ("length"), filtered or refused completions, empty content and
+    # anything the caller can't use would otherwise be served for the full TTL
+    if (
+        use_cache
+        and finish_reason == "stop"
+        and content
+        and (validate is None or validate(content))
+    ):
+        await llm_cache.set(model, messages, temperature, content, response_format)
+    return content
+
+
+async def embed_text(text: str, model="text-embedding-3-small") -> list:
+    """One embedding, throttled and retried the same way as completions."""
+    estimated = estimate_tokens(text)
+    async for attempt in _retrying():
+        with attempt:
+            async with _openai_slots:
+                await rate_limiter.acquire(estimated)
+                resp = await client.embeddings.create(model=model, input=text)
+    if resp.usage is not None:
+        rate_limiter.release_extra(resp.usage.total_tokens - estimated)
+    return resp.data[0].embedding
+
+
+async def stream_openai(messages, model=HANDLER_MODEL, temperature=0.2):
+    """
+    Like call_openai, but yields content deltas as they arrive. Only
+    opening the stream is retried; once tokens have gone out, a failure
+    is raised to the caller. Streams skip the exact-match cache.
+    """
+    estimated = _estimate_call_tokens(messages)
+    # The slot is taken per attempt (as in call_openai), so backoff sleeps
+    # don't hold it; a successful attempt keeps it until the stream ends
+    async for attempt in _retrying():
+        with attempt:
+            await _openai_slots.acquire()
+            try:
+                await rate_limiter.acquire(estimated)
+                stream = await client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+            except BaseException:
+                _openai_slots.release()
+                raise
+
+    usage = None
+    try:
+        async for chunk in stream:
+            if chunk.choices:
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+            if chunk.usage is not None:
+                usage = chunk.usage
+    finally:
+        _openai_slots.release()
+
+    if usage is not None:
+        rate_limiter.release_extra(usage.total_tokens - estimated)
+
+
+# Reply used when the OpenAI call itself fails
+FALLBACK_REPLY_TEXT = (
+    "Hi there,\n\n"
+    "Thanks for reaching out. I saw your note and will follow up shortly.\n\n"
+    "Cheers,\n"
+    "David"
+)
+
+
+# Every LEAD_SCHEMA key with a neutral value; fallback results are built by
+# merging over this in one dict display
+_LEAD_DEFAULTS = {
+    "name": None,
+    "email": None,
+    "phone": None,
+    "lead_type": "Other",
+    "priority": "Medium",
+    "summary": "",
+    "reply": "",
+}
+
+
+# Micro-batching: leads arriving within a short window share one completion,
+# so bursts cost one request against the RPM quota instead of N.
+BATCH_WINDOW_SECONDS = float(os.getenv("LEAD_BATCH_WINDOW_MS", "50")) / 1000
+BATCH_MAX_LEADS = int(os.getenv("LEAD_BATCH_MAX", "8"))
+# Rough input budget per batch so a burst of long emails can't overflow context
+BATCH_MAX_PROMPT_TOKENS = int(os.getenv("LEAD_BATCH_MAX_TOKENS", "12000"))
+
+
+# One worked example pins down the reply tone, length and closing, and shows
+# how sparse emails map onto the schema (e.g. a missing email becomes null)
+FEW_SHOTS = """
+Example email:
+\"\"\"
+Hi David, my husband and I are hoping to buy a 3 bedroom townhouse on Burke
+Mountain in the next few months. We're pre-approved up to $1.1M. Could we set
+up a time to chat? - Priya Shah, 604-555-0142
+\"\"\"
+Example response:
+{"name": "Priya Shah", "email": null, "phone": "604-555-0142", "lead_type": "Buyer", "priority": "High", "summary": "Pre-approved couple (up to $1.1M) looking for a 3 bedroom townhouse on Burke Mountain within a few months; wants to set up a call.", "reply": "Hi Priya,\\n\\nThanks for reaching out. Burke Mountain has some good townhouse options in that range right now, and being pre-approved puts you in a strong spot.\\n\\nWould a quick call tomorrow or Thursday work? I can walk you through what is available and what has sold recently.\\n\\nCheers, David"}
+"""
+
+# Everything static lives in the system message and only the email goes in
+# the user turn, so the prompt is a byte-identical prefix plus the email.
+# At roughly 400 tokens it is below the 1024 OpenAI's automatic prompt
+# caching needs, so nothing is discounted yet; the layout just keeps it
+# eligible if the instructions grow.
+LEAD_SYSTEM_PROMPT = (
+    BASE_SYSTEM_PROMPT
+    + "\n\nExtract lead details from the email the user sends and write a "
+    "reply in Dave's style.\n"
+    + JSON_INSTRUCTIONS
+    + FEW_SHOTS
+)
+SYSTEM_MSG = {"role": "system", "content": LEAD_SYSTEM_PROMPT}
+
+# Batches extend the same static prefix with one extra instruction
+BATCH_SYSTEM_MSG = {
+    "role": "system",
+    "content": LEAD_SYSTEM_PROMPT
+    + "\nWhen the user sends several numbered emails, respond with a JSON object "
+    'of the form {"leads": [...]}, where the list holds one lead object per '
+    "email, in the same order as the emails.\n",
+}
+
+# Contact details are plain pattern matches; spotting them up front saves the
+# model the work and lets us backfill fields it leaves empty
+EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+PHONE_RE = re.compile(r"(?:\+?1[-.\s]?)?\(?\d{3}\)?[-.\s]?\d{3}[-.\s]?\d{4}")
+
+# Dave's own details show up in signatures and quoted replies; never offer
+# them as the lead's
+_OWN_EMAIL_SUFFIX = "@reimers.ca"
+_OWN_PHONE_DIGITS = "6043409822"
+
+
+def detect_contact(text: str) -> tuple:
+    """First (email, phone) in text that isn't Dave's own; either may be None."""
+    email = next(
+        (
+            m
+            for m in (e.rstrip(".") for e in EMAIL_RE.findall(text))
+            if not m.lower().endswith(_OWN_EMAIL_SUFFIX)
+        ),
+        None,
+    )
+    phone = next(
+        (
+            m
+            for m in PHONE_RE.findall(text)
+            if re.sub(r"\D", "", m)[-10:] != _OWN_PHONE_DIGITS
+        ),
+        None,
+    )
+    return email, phone
+
+
+def contact_hint(contact: tuple) -> str:
+    """
+    Prompt line naming the detected (email, phone), leaving out whichever
+    wasn't found; "" if neither was.
+    """
+    found = [f"{k}={v}" for k, v in zip(("email", "phone"), contact) if v]
+    if not found:
+        return ""
+    return f"\nDetected: {' '.join(found)}. Confirm and fill remaining fields."
+
+
+# User turns are filled with one % substitution each; the email goes inside
+# the triple quotes, followed by the contact hint (if any)
+_LEAD_USER_TEMPLATE = 'Email:\n"""\n%s\n"""%s'.__mod__
+_BATCH_ITEM_TEMPLATE = "[%d]\n%s%s".__mod__
+BATCH_USER_PREFIX = "Emails:\n"
+
+
+def build_lead_messages(email_text: str, contact=None) -> list:
+    """
+    Messages for a single lead-extraction call. contact is the email's
+    detect_contact() output, if the caller already has it.
+    """
+    if contact is None:
+        contact = detect_contact(email_text)
+    content = _LEAD_USER_TEMPLATE((email_text, contact_hint(contact)))
+    return [
+        SYSTEM_MSG,
+        {"role": "user", "content": content},
+    ]
+
+
+def build_batch_messages(email_texts: list, contacts=None) -> list:
+    """
+    Messages for one call covering several numbered emails. contacts, if
+    given, holds each email's detect_contact() output in the same order.
+    """
+    if contacts is None:
+        contacts = [detect_contact(text) for text in email_texts]
+    numbered = "\n\n".join(
+        _BATCH_ITEM_TEMPLATE((i, text, contact_hint(contact)))
+        for i, (text, contact) in enumerate(zip(email_texts, contacts), start=1)
+    )
+    return [
+        BATCH_SYSTEM_MSG,
+        {"role": "user", "content": BATCH_USER_PREFIX + numbered},
+    ]
+
+
+# Plain-text replies (no extraction) for callers that stream tokens to a person
+REPLY_SYSTEM_MSG = {
+    "role": "system",
+    "content": BASE_SYSTEM_PROMPT
+    + "\n\nWrite a reply in Dave's style to the email the user sends. "
+    "Respond with the reply text only. Do not include David's full email "
+    'signature block; end with a natural closing like "Cheers, David".',
+}
+_REPLY_USER_TEMPLATE = 'Email:\n"""\n%s\n"""'.__mod__
+
+# The static system prompts go out on every call; count them once here
+_SYSTEM_TOKENS = {
+    m["content"]: estimate_tokens(m["content"])
+    for m in (SYSTEM_MSG, BATCH_SYSTEM_MSG, REPLY_SYSTEM_MSG)
+}
+
+
+def stream_reply(email_text: str, model=None):
+    """Async iterator over the tokens of a plain reply to email_text."""
+    email_text = trim_email(email_text)
+    messages = [
+        REPLY_SYSTEM_MSG,
+        {"role": "user", "content": _REPLY_USER_TEMPLATE(email_text)},
+    ]
+    return stream_openai(messages, model=select_lead_model(email_text, model))
+
+
+class LeadBatcher:
+    """
+    Collects pending lead emails for up to BATCH_WINDOW_SECONDS (or
+    BATCH_MAX_LEADS) and sends them to OpenAI as one request. Only leads
+    bound for the same model share a batch.
+    Each caller gets back the raw JSON content for its own lead. Results
+    are cached under the single-lead key, so a repeat lead is answered from
+    llm_cache whether it first went out alone or in a batch.
+    """
+
+    temperature = 0.2
+
+    def __init__(self, window_seconds, max_leads, max_prompt_tokens):
+        self.window_seconds = window_seconds
+        self.max_leads = max_leads
+        self.max_prompt_tokens = max_prompt_tokens
+        self._queue = None
+        self._task = None
+        self._inflight = set()
+
+    def start(self):
+        # Queue is created here so it belongs to the serving event loop
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+            self._task.add_done_callback(self._on_run_done)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _on_run_done(self, task):
+        # Whether stopped or crashed, later submits call OpenAI directly and
+        # nobody is left waiting on a lead the loop will never dispatch
+        self._task = None
+        error = None if task.cancelled() else task.exception()
+        if error is not None:
+            logger.error("Lead batcher stopped unexpectedly: %s", error)
+        while not self._queue.empty():
+            _, _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(error or RuntimeError("lead batcher stopped"))
+
+    async def submit(self, email_text: str, model=HANDLER_MODEL, contact=None) -> str:
+        if contact is None:
+            contact = detect_contact(email_text)
+        messages = build_lead_messages(email_text, contact)
+        # Not running (e.g. no serving loop): just make the single call
+        if self._task is None:
+            return await call_openai(
+                messages=messages,
+                model=model,
+                temperature=self.temperature,
+                response_format=LEAD_RESPONSE_FORMAT,
+            )
+
+        # A lead answered before doesn't need to wait for a batch window
+        cached = await llm_cache.get(
+            model, messages, self.temperature, LEAD_RESPONSE_FORMAT
+        )
+        if cached is not None:
+            return cached
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((email_text, model, future, contact))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        batch = []
+        carry = None
+        try:
+            while True:
+                batch = [carry or await self._queue.get()]
+                first = batch[0]
+                carry = None
+                tokens = estimate_tokens(first[0])
+                deadline = loop.time() + self.window_seconds
+
+                while len(batch) < self.max_leads:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    # In the batch before anything can raise, so it's failed with it
+                    batch.append(item)
+                    tokens += estimate_tokens(item[0])
+                    if item[1] != first[1] or tokens > self.max_prompt_tokens:
+                        carry = batch.pop()
+                        break
+
+                # Dispatch without blocking collection of the next batch
+                task = asyncio.create_task(self._dispatch(batch))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+                batch = []
+        except BaseException as e:
+            # Leads already pulled off the queue would otherwise wait forever
+            error = e
+            if isinstance(e, asyncio.CancelledError):
+                error = RuntimeError("lead batcher stopped")
+            for _, _, future, _ in batch + ([carry] if carry else []):
+                if not future.done():
+                    future.set_exception(error)
+            raise
+
+    async def _dispatch(self, batch):
+        model = batch[0][1]
+        # The same email submitted twice in one window is sent once
+        waiting = {}
+        contacts = {}
+        for text, _, future, contact in batch:
+            waiting.setdefault(text, []).append(future)
+            contacts[text] = contact
+        texts = list(waiting)
+
+        if len(texts) > 1:
+            try:
+                content = await call_openai(
+                    messages=build_batch_messages(
+                        texts, [contacts[text] for text in texts]
+                    ),
+                    model=model,
+                    temperature=self.temperature,
+                    response_format=LEAD_BATCH_RESPONSE_FORMAT,
+                    # Only a complete batch is worth caching
+                    validate=lambda c: _batch_leads(c, len(texts)) is not None,
+                )
+            except Exception as e:
+                # Already retried; one retry per lead would only multiply it
+                for futures in waiting.values():
+                    _resolve(futures, error=e)
+                return
+            results = _batch_leads(content, len(texts))
+            if results is not None:
+                for text, item in zip(texts, results):
+                    item_content = orjson.dumps(item).decode()
+                    if isinstance(item, dict):
+                        await llm_cache.set(
+                            model,
+                            build_lead_messages(text, contacts[text]),
+                            self.temperature,
+                            item_content,
+                            LEAD_RESPONSE_FORMAT,
+                        )
+                    _resolve(waiting[text], result=item_content)
+                return
+            logger.warning("Lead batch result count mismatch, retrying individually")
+
+        # Single lead, or a batch whose output didn't line up with its leads
+        await asyncio.gather(
+            *(
+                self._dispatch_one(text, contacts[text], model, waiting[text])
+                for text in texts
+            )
+        )
+
+    async def _dispatch_one(self, email_text, contact, model, futures):
+        try:
+            content = await call_openai(
+                messages=build_lead_messages(email_text, contact),
+                model=model,
+                temperature=self.temperature,
+                response_format=LEAD_RESPONSE_FORMAT,
+            )
+        except Exception as e:
+            _resolve(futures, error=e)
+        else:
+            _resolve(futures, result=content)
+
+
+def _resolve(futures, result=None, error=None):
+    """Settle every future still waiting on one lead."""
+    for future in futures:
+        if future.done():
+            continue
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+
+def _batch_leads(content: str, count: int):
+    """The "leads" list from a batch completion, or None unless it has count items."""
+    try:
+        leads = orjson.loads(content).get("leads")
+    except (orjson.JSONDecodeError, AttributeError):
+        return None
+    if not isinstance(leads, list) or len(leads) != count:
+        return None
+    return leads
+
+
+lead_batcher = LeadBatcher(
+    BATCH_WINDOW_SECONDS, BATCH_MAX_LEADS, BATCH_MAX_PROMPT_TOKENS
+)
+
+
+# Smart punctuation -> plain ASCII, applied in a single str.translate pass
+_PUNCT_TRANS = str.maketrans(
+    {
+        "\u201c": '"',  # left double quote
+        "\u201d": '"',  # right double quote
+        "\u201e": '"',  # low double quote
+        "\u00ab": '"',  # left guillemet
+        "\u00bb": '"',  # right guillemet
+        "\u2018": "'",  # left single quote
+        "\u2019": "'",  # right single quote
+        "\u201a": "'",  # low single quote
+        "\u2013": "-",  # en dash
+        "\u2014": "-",  # em dash
+        "\u2212": "-",  # minus sign
+        "\u00a0": " ",  # non-breaking space
+    }
+)
+
+
+def normalize_punctuation(text: str) -> str:
+    """
+    Convert common smart punctuation to plain ASCII.
+    We do NOT strip all non-ASCII (to avoid breaking names), just the usual suspects.
+    """
+    # Fast path: pure-ASCII text (most web-form leads) has nothing to replace
+    if not isinstance(text, str) or not text or text.isascii():
+        return text
+
+    text = text.translate(_PUNCT_TRANS)
+    # The ellipsis is the only multi-character replacement
+    if "\u2026" in text:
+        text = text.replace("\u2026", "...")
+    return text
+
+
+# Keyword routes for lead types, combined into one alternation so each field
+# is scanned once no matter how many keywords are added
+_ROUTE_RE = re.compile(r"\b(foreclosure|vipma|home\s+evaluation)\b", re.IGNORECASE)
+_ROUTE_LEAD_TYPES = {
+    "foreclosure": "Foreclosure",
+    "vipma": "VIPMA",
+    "home evaluation": "Home Evaluation",
+}
+
+
+def detect_lead_type(subject: str, body: str, form_name: str = ""):
+    """
+    Return the lead_type implied by a routing keyword in the form name,
+    subject or body (checked in that order), or None if there isn't one.
+    """
+    m = (
+        _ROUTE_RE.search(form_name)
+        or _ROUTE_RE.search(subject)
+        or _ROUTE_RE.search(body)
+    )
+    if not m:
+        return None
+    return _ROUTE_LEAD_TYPES[" ".join(m.group(1).lower().split())]
+
+
+# Structured web forms we can answer without GPT. Keyed on the lowercased
+# form_name the caller sends; templates are compiled once at import.
+FORM_RULES = {
+    "home evaluation": {
+        "lead_type": "Home Evaluation",
+        "priority": "High",
+        "reply": Template(
+            "Hi {{ first_name }},\n\n"
+            "Thanks for requesting a home evaluation. I will pull recent comparable "
+            "sales for your area and be in touch shortly to confirm a few details "
+            "about the property.\n\n"
+            "Cheers, David"
+        ),
+    },
+    "seller": {
+        "lead_type": "Seller",
+        "priority": "High",
+        "reply": Template(
+            "Hi {{ first_name }},\n\n"
+            "Thanks for reaching out about selling your home. I will follow up "
+            "shortly to talk through timing, pricing and next steps.\n\n"
+            "Cheers, David"
+        ),
+    },
+    "buyer": {
+        "lead_type": "Buyer",
+        "priority": "Medium",
+        "reply": Template(
+            "Hi {{ first_name }},\n\n"
+            "Thanks for reaching out about buying. I would be happy to help. I will "
+            "follow up shortly to learn more about what you are looking for and "
+            "your timing.\n\n"
+            "Cheers, David"
+        ),
+    },
+}
+
+
+def try_rules_based_result(form_data: dict, subject: str, body: str):
+    """
+    Build the full lead result directly from a known structured form, skipping GPT.
+    Returns None unless the form is one we have a rule for and we know who to reply to.
+    """
+    form_name = " ".join((form_data.get("form_name") or "").lower().split())
+    rule = FORM_RULES.get(form_name)
+    if rule is None or not form_data.get("from_email"):
+        return None
+
+    name = normalize_punctuation((form_data.get("from_name") or "").strip()) or None
+    first_name = name.split()[0] if name else "there"
+    return {
+        "name": name,
+        "email": form_data.get("from_email"),
+        "phone": form_data.get("phone"),
+        "lead_type": rule["lead_type"],
+        "priority": rule["priority"],
+        "summary": normalize_punctuation(
+            f"{subject}: {body}" if subject else body
+        )[:500],
+        "reply": rule["reply"].render(first_name=first_name),
+    }
+
+
+# Quoted reply lines, "On ... wrote:" attributions and forward/original-message
+# banners carry no new lead signal; one pass strips all of them
+_EMAIL_NOISE_RE = re.compile(
+    r"^(?:[ \t]*>.*"
+    r"|On .{0,200}wrote:[ \t]*"
+    r"|[ \t]*-{2,}[ \t]*(?i:forwarded message|original message)[ \t]*-{2,}[ \t]*)"
+    r"(?:\n|$)",
+    re.MULTILINE,
+)
+_BLANK_RUN_RE = re.compile(r"\n{3,}")
+
+# Prompt cost and latency grow linearly with the email, so cap it
+MAX_EMAIL_CHARS = int(os.getenv("MAX_EMAIL_CHARS", "4000"))
+_TRIM_MARKER = "\n...[trimmed]...\n"
+
+
+def trim_email(text: str, max_chars: int = MAX_EMAIL_CHARS) -> str:
+    """
+    Drop quoted-reply noise, then keep the head and tail of anything still
+    longer than max_chars (the first message and the signature carry most
+    of the lead signal). The result, marker included, is at most max_chars.
+    """
+    cleaned = _BLANK_RUN_RE.sub("\n\n", _EMAIL_NOISE_RE.sub("", text)).strip()
+    # An email that is nothing but quoted text is still better than nothing
+    text = cleaned or text
+    if len(text) <= max_chars:
+        return text
+    budget = max_chars - len(_TRIM_MARKER)
+    # No room for the marker: a plain cut is the only way to stay under
+    if budget <= 0:
+        return text[:max_chars]
+    head = budget * 3 // 4
+    tail = budget - head
+    # text[-0:] would be the whole text, so a zero-length tail is skipped
+    return text[:head] + _TRIM_MARKER + (text[-tail:] if tail else "")
+
+
+def finalize_lead_result(
+    parsed: dict, contact=(None, None), lead_type_hint=None
+) -> dict:
+    """
+    Shared last step for model results, realtime or Batch API: normalize
+    punctuation, backfill email/phone the model left empty from contact
+    (detect_contact() output) and fall back to lead_type_hint
+    (detect_lead_type() output) when the model said "Other".
+    LEAD_SCHEMA guarantees every key is present, so no defaults are needed.
+    """
+    # Normalize punctuation on text fields
+    for k in ["name", "email", "phone", "summary", "reply"]:
+        if parsed.get(k):
+            parsed[k] = normalize_punctuation(parsed[k])
+
+    email, phone = contact
+    parsed["email"] = parsed.get("email") or email
+    parsed["phone"] = parsed.get("phone") or phone
+    if lead_type_hint and parsed.get("lead_type") in (None, "Other"):
+        parsed["lead_type"] = lead_type_hint
+    return parsed
+
+
+# Opening salutation of a reply ("Hi Priya," and the blank line after it)
+_GREETING_RE = re.compile(r"^(?:hi|hello|hey|dear)\b[^\n]*\n+", re.IGNORECASE)
+
+
+def _semantic_entry(parsed: dict):
+    """
+    The part of a lead result that carries over to a paraphrase from someone
+    else, for the semantic cache: lead_type, priority and the reply without
+    its greeting. The summary describes this one email, so it is never
+    cached. None if the reply body still mentions the sender's name, email
+    or phone.
+    """
+    reply_body = _GREETING_RE.sub("", parsed.get("reply") or "", count=1)
+    needles = [parsed.get("email"), parsed.get("phone")]
+    needles += (parsed.get("name") or "").split()
+    lowered = reply_body.lower()
+    if not reply_body or any(n and n.lower() in lowered for n in needles):
+        return None
+    return {
+        "lead_type": parsed.get("lead_type"),
+        "priority": parsed.get("priority"),
+        "reply_body": reply_body,
+    }
+
+
+def _result_from_semantic_entry(
+    entry: dict, contact: tuple, preview: str, sender_name=None
+) -> dict:
+    """
+    Rebuild a lead result from a cached entry for the current email: contact
+    is its detect_contact() output and preview its body[:500], used as the
+    summary.
+    """
+    email, phone = contact
+    name = normalize_punctuation((sender_name or "").strip())
+    first_name = name.split()[0] if name else "there"
+    return {
+        **_LEAD_DEFAULTS,
+        "email": email,
+        "phone": phone,
+        "lead_type": entry["lead_type"],
+        "priority": entry["priority"],
+        "summary": preview,
+        "reply": f"Hi {first_name},\n\n" + entry["reply_body"],
+        "cache": "semantic_hit",
+    }
+
+
+async def handle_gmail_lead_reply(
+    email_text: str,
+    model=None,
+    preview=None,
+    sender_name=None,
+    lead_type_hint=None,
+) -> dict:
+    """
+    Extract lead details and write a reply in Dave's style.
+    Returns a dict matching JSON_INSTRUCTIONS. model overrides the
+    length-based choice from select_lead_model(); preview is the caller's
+    already-sliced body[:500], reused as the fallback summary; sender_name
+    (the request's from_name) addresses replies rebuilt from the semantic
+    cache; lead_type_hint replaces an "Other" lead_type.
+    """
+    if preview is None:
+        preview = email_text[:500]
+    email_text = trim_email(email_text)
+    # Found once; it goes into the prompt and backfills the result
+    contact = detect_contact(email_text)
+
+    # Semantic cache: a paraphrase of a lead we've already answered
+    # (keyed on the lowercased, whitespace-collapsed body). Only the
+    # sender-independent fields are cached; contact details, summary and the
+    # greeting are rebuilt from this email. The body is embedded once here
+    # and the vector is shared by the lookup and the store after a miss.
+    vector = None
+    if semantic_cache is not None:
+        cache_text = " ".join(email_text.lower().split())
+        try:
+            vector = await embed_text(cache_text[:2000])
+            hit = await semantic_cache.acheck(
+                prompt=cache_text, vector=vector, num_results=1
+            )
+            if hit:
+                entry = orjson.loads(hit[0]["response"])
+                cached = _result_from_semantic_entry(
+                    entry, contact, preview, sender_name
+                )
+                return finalize_lead_result(cached, lead_type_hint=lead_type_hint)
+        except Exception as e:
+            logger.warning("Semantic cache lookup failed: %s", e)
+
+    try:
+        content = await lead_batcher.submit(
+            email_text, model=select_lead_model(email_text, model), contact=contact
+        )
+        parsed = orjson.loads(content)
+    except Exception as e:
+        # If OpenAI call fails, we still return a minimal structure
+        return {
+            **_LEAD_DEFAULTS,
+            "lead_type": lead_type_hint or "Other",
+            "summary": preview,
+            "reply": FALLBACK_REPLY_TEXT,
+            "error": f"openai_error: {str(e)}",
+        }
+
+    parsed = finalize_lead_result(parsed, contact, lead_type_hint)
+
+    entry = _semantic_entry(parsed) if vector is not None else None
+    if entry is not None:
+        try:
+            await semantic_cache.astore(
+                prompt=cache_text,
+                response=orjson.dumps(entry).decode(),
+                vector=vector,
+            )
+        except Exception as e:
+            logger.warning("Semantic cache store failed: %s", e)
+
+    return parsed
+
+
+# Metadata marker on every batch submit_lead_batch creates; fetch_lead_batch
+# won't read anything else the API key can see
+LEAD_BATCH_SOURCE = "dave_lead"
+
+
+async def _batch_request(method, *args, **kwargs):
+    """A Files/Batch API request under the same retry policy as completions."""
+    async for attempt in _retrying():
+        with attempt:
+            result = await method(*args, **kwargs)
+    return result
+
+
+async def submit_lead_batch(
+    email_text: str, model=None, temperature=0.2, lead_type_hint=None
+) -> dict:
+    """
+    Queue a lead through the OpenAI Batch API (half price, up to 24h turnaround)
+    instead of the realtime endpoint. Poll the result with fetch_lead_batch().
+    The model is picked exactly as in handle_gmail_lead_reply (model is the
+    override); the contact details and lead_type_hint ride along as batch
+    metadata so fetch_lead_batch() can finalize the same way.
+    """
+    email_text = trim_email(email_text)
+    model = select_lead_model(email_text, model)
+    contact = detect_contact(email_text)
+    email, phone = contact
+    metadata = {"source": LEAD_BATCH_SOURCE}
+    hints = (("email", email), ("phone", phone), ("lead_type", lead_type_hint))
+    for key, value in hints:
+        if value:
+            metadata[key] = value
+    line = {
+        "custom_id": str(uuid.uuid4()),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model,
+            "messages": build_lead_messages(email_text, contact),
+            "temperature": temperature,
+            "response_format": LEAD_RESPONSE_FORMAT,
+        },
+    }
+    upload = await _batch_request(
+        client.files.create,
+        file=("lead.jsonl", orjson.dumps(line) + b"\n"),
+        purpose="batch",
+    )
+    try:
+        batch = await _batch_request(
+            client.batches.create,
+            input_file_id=upload.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+            metadata=metadata,
+        )
+    except Exception:
+        # Don't leave the lead's email sitting in an unused upload
+        try:
+            await client.files.delete(upload.id)
+        except Exception as e:
+            logger.warning("Could not delete batch upload %s: %s", upload.id, e)
+        raise
+    return {"batch_id": batch.id, "status": "queued"}
+
+
+async def _first_batch_line(file_id):
+    """The first JSONL record of a batch output/error file, or None if there is none."""
+    if not file_id:
+        return None
+    output = await _batch_request(client.files.content, file_id)
+    lines = output.content.splitlines()
+    return orjson.loads(lines[0]) if lines else None
+
+
+async def fetch_lead_batch(batch_id: str):
+    """
+    Look up a queued lead batch. Once completed, the output is parsed into
+    the usual lead result dict under "result", or the failure under "error".
+    None if batch_id isn't a batch queued by submit_lead_batch().
+    """
+    batch = await _batch_request(client.batches.retrieve, batch_id)
+    metadata = batch.metadata or {}
+    if metadata.get("source") != LEAD_BATCH_SOURCE:
+        return None
+    out = {"batch_id": batch.id, "status": batch.status}
+    if batch.status != "completed":
+        return out
+
+    # A request that failed lands in the error file, not the output file
+    line = await _first_batch_line(batch.output_file_id)
+    if line is None:
+        line = await _first_batch_line(batch.error_file_id)
+    if line is None:
+        out["error"] = "batch completed without output"
+        return out
+    if line.get("error") or line["response"]["status_code"] != 200:
+        out["error"] = line.get("error") or line["response"]["body"]
+        return out
+
+    content = line["response"]["body"]["choices"][0]["message"]["content"]
+    out["result"] = finalize_lead_result(
+        orjson.loads(content),
+        (metadata.get("email"), metadata.get("phone")),
+        metadata.get("lead_type"),
+    )
+    return out
+
+
+# Static HTML pieces, built once at import
+DEFAULT_BODY_HTML = "<p>Hi there,</p><p>Thanks for your message. I will review it and follow up with next steps.</p>"
+
+# Default HTML signature (ASCII-friendly)
+SIGNATURE_HTML = """
+<p>Cheers,<br>
+David Reimers PREC*<br>
+Royal LePage West Real Estate Services<br>
+604-340-9822<br>
+<a href="https://reimers.ca">reimers.ca</a></p>
+""".strip()
+
+
+# Paragraph breaks (2+ newlines) and in-paragraph line breaks
+_PARA_RE = re.compile(r"\n{2,}")
+_BR_TRANS = str.maketrans({"\n": "<br>"})
+
+
+@lru_cache(maxsize=512)
+def _reply_text_to_html(reply_text: str) -> str:
+    """
+    Turn already-normalized reply text into paragraph HTML. The text is
+    escaped first: it carries caller-supplied names and model output, and
+    the HTML is emailed from David's account.
+    """
+    parts = [p for p in (s.strip() for s in _PARA_RE.split(reply_text)) if p]
+    if not parts:
+        return DEFAULT_BODY_HTML
+    return (
+        "<p>"
+        + "</p><p>".join(html.escape(p).translate(_BR_TRANS) for p in parts)
+        + "</p>"
+    )
+
+
+def build_reply_html_from_result(result: dict) -> str:
+    """
+    Take the GPT result dict and build final HTML reply, with:
+    - normalized ASCII punctuation
+    - default HTML signature appended
+    """
+    reply_text = normalize_punctuation(result.get("reply") or "")
+    body_html = _reply_text_to_html(reply_text) if reply_text else DEFAULT_BODY_HTML
+    return f"{body_html}\n{SIGNATURE_HTML}"
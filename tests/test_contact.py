@@ -0,0 +1,72 @@
+import os
+import unittest
+from unittest import mock
+
+import orjson
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import dave_core  # noqa: E402
+from dave_core import build_lead_messages, contact_hint, detect_contact  # noqa: E402
+
+
+class DetectContactTests(unittest.TestCase):
+    def test_finds_first_email_and_phone(self):
+        text = "Reach me at jane.doe+home@mail.example.com. or (604) 555-0199 anytime"
+        self.assertEqual(
+            detect_contact(text), ("jane.doe+home@mail.example.com", "(604) 555-0199")
+        )
+
+    def test_skips_daves_own_details(self):
+        text = (
+            "From David@Reimers.ca, 604-340-9822\n"
+            "Buyer: sam@example.com, +1 778 555 0100"
+        )
+        self.assertEqual(detect_contact(text), ("sam@example.com", "+1 778 555 0100"))
+
+    def test_nothing_found(self):
+        self.assertEqual(detect_contact("Call me about the listing"), (None, None))
+
+
+class ContactHintTests(unittest.TestCase):
+    def test_both_fields(self):
+        self.assertEqual(
+            contact_hint(("a@b.com", "604-555-0199")),
+            "\nDetected: email=a@b.com phone=604-555-0199. "
+            "Confirm and fill remaining fields.",
+        )
+
+    def test_missing_field_is_left_out(self):
+        self.assertEqual(
+            contact_hint((None, "604-555-0199")),
+            "\nDetected: phone=604-555-0199. Confirm and fill remaining fields.",
+        )
+        self.assertNotIn("None", contact_hint(("a@b.com", None)))
+
+    def test_neither_field(self):
+        self.assertEqual(contact_hint((None, None)), "")
+
+    def test_lead_messages_use_the_given_contact(self):
+        messages = build_lead_messages("no details here", ("a@b.com", None))
+        self.assertIn("Detected: email=a@b.com.", messages[-1]["content"])
+
+
+class HandleLeadContactTests(unittest.IsolatedAsyncioTestCase):
+    async def test_contact_is_detected_once_per_lead(self):
+        call = mock.AsyncMock(return_value=orjson.dumps({"reply": "Hi"}).decode())
+        detect = mock.Mock(wraps=detect_contact)
+        with mock.patch.object(dave_core, "call_openai", call), mock.patch.object(
+            dave_core, "detect_contact", detect
+        ), mock.patch.object(dave_core, "semantic_cache", None):
+            result = await dave_core.handle_gmail_lead_reply(
+                "Selling soon, sam@example.com"
+            )
+
+        detect.assert_called_once()
+        self.assertEqual(result["email"], "sam@example.com")
+        prompt = call.await_args.kwargs["messages"][-1]["content"]
+        self.assertIn("email=sam@example.com", prompt)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import orjson
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import dave_core  # noqa: E402
+from dave_core import fetch_lead_batch, submit_lead_batch  # noqa: E402
+
+LEAD = {
+    "name": "Alice Smith",
+    "email": None,
+    "phone": None,
+    "lead_type": "Other",
+    "priority": "Medium",
+    "summary": "Wants a valuation",
+    "reply": "Hi Alice,\n\nHappy to help.\n\nCheers, David",
+}
+
+
+def _record(status_code, body, error=None):
+    response = {"status_code": status_code, "body": body}
+    return orjson.dumps({"custom_id": "c1", "response": response, "error": error})
+
+
+class FakeBatchClient:
+    """Just enough of AsyncOpenAI's files/batches surface for one batch."""
+
+    def __init__(self):
+        self.files_by_id = {}
+        self.deleted = []
+        self.batch = None
+        self.create_error = None
+        self.files = SimpleNamespace(
+            create=self._files_create,
+            content=self._files_content,
+            delete=self._files_delete,
+        )
+        self.batches = SimpleNamespace(
+            create=self._batches_create, retrieve=self._batches_retrieve
+        )
+
+    async def _files_create(self, file, purpose):
+        file_id = f"file-{len(self.files_by_id) + 1}"
+        self.files_by_id[file_id] = file[1]
+        return SimpleNamespace(id=file_id)
+
+    async def _files_content(self, file_id):
+        return SimpleNamespace(content=self.files_by_id[file_id])
+
+    async def _files_delete(self, file_id):
+        self.deleted.append(file_id)
+
+    async def _batches_create(self, input_file_id, metadata, **kwargs):
+        if self.create_error is not None:
+            raise self.create_error
+        self.batch = SimpleNamespace(
+            id="batch-1",
+            status="validating",
+            metadata=metadata,
+            output_file_id=None,
+            error_file_id=None,
+        )
+        return self.batch
+
+    async def _batches_retrieve(self, batch_id):
+        return self.batch
+
+    def complete(self, output=None, errors=None):
+        self.batch.status = "completed"
+        if output is not None:
+            self.files_by_id["file-out"] = output
+            self.batch.output_file_id = "file-out"
+        if errors is not None:
+            self.files_by_id["file-err"] = errors
+            self.batch.error_file_id = "file-err"
+
+
+class LeadBatchApiTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = FakeBatchClient()
+        patcher = mock.patch.object(dave_core, "client", self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.email = "Please value my home. alice@x.com 604-555-0001"
+
+    async def test_completed_batch_is_finalized_with_its_metadata(self):
+        queued = await submit_lead_batch(self.email, lead_type_hint="Home Evaluation")
+        self.assertEqual(queued, {"batch_id": "batch-1", "status": "queued"})
+        self.assertEqual(self.client.batch.metadata["source"], "dave_lead")
+
+        self.assertEqual(
+            await fetch_lead_batch("batch-1"),
+            {"batch_id": "batch-1", "status": "validating"},
+        )
+
+        body = {"choices": [{"message": {"content": orjson.dumps(LEAD).decode()}}]}
+        self.client.complete(output=_record(200, body) + b"\n")
+        out = await fetch_lead_batch("batch-1")
+        self.assertEqual(out["result"]["email"], "alice@x.com")
+        self.assertEqual(out["result"]["phone"], "604-555-0001")
+        self.assertEqual(out["result"]["lead_type"], "Home Evaluation")
+
+    async def test_failed_request_is_read_from_the_error_file(self):
+        await submit_lead_batch(self.email)
+        error_body = {"error": {"message": "bad schema"}}
+        self.client.complete(output=b"", errors=_record(400, error_body) + b"\n")
+        out = await fetch_lead_batch("batch-1")
+        self.assertEqual(out["error"], error_body)
+        self.assertNotIn("result", out)
+
+    async def test_completed_without_any_file_reports_an_error(self):
+        await submit_lead_batch(self.email)
+        self.client.complete()
+        out = await fetch_lead_batch("batch-1")
+        self.assertEqual(out["error"], "batch completed without output")
+
+    async def test_batches_without_the_marker_are_refused(self):
+        self.client.batch = SimpleNamespace(
+            id="batch-x", status="completed", metadata={}, output_file_id="file-1"
+        )
+        self.assertIsNone(await fetch_lead_batch("batch-x"))
+
+    async def test_upload_is_deleted_when_the_batch_cannot_be_created(self):
+        self.client.create_error = ValueError("invalid input")
+        with self.assertRaises(ValueError):
+            await submit_lead_batch(self.email)
+        self.assertEqual(self.client.deleted, ["file-1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
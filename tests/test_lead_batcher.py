@@ -0,0 +1,159 @@
+import asyncio
+import os
+import re
+import unittest
+from unittest import mock
+
+import orjson
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import dave_core  # noqa: E402
+from dave_core import LeadBatcher  # noqa: E402
+
+_NUMBERED_RE = re.compile(r"^\[\d+\]\n(\S+)", re.MULTILINE)
+_SINGLE_RE = re.compile(r'^Email:\n"""\n(\S+)', re.MULTILINE)
+
+
+class FakeOpenAI:
+    """
+    Replaces dave_core.call_openai. Each lead comes back named after its
+    email text, so tests can check every caller got its own result.
+    """
+
+    def __init__(self, drop_from_batch=0):
+        self.drop_from_batch = drop_from_batch
+        self.error = None
+        self.calls = []
+
+    async def __call__(self, messages, model, response_format=None, **kwargs):
+        user = messages[-1]["content"]
+        if self.error is not None:
+            self.calls.append((model, None))
+            raise self.error
+        if response_format is dave_core.LEAD_BATCH_RESPONSE_FORMAT:
+            texts = _NUMBERED_RE.findall(user)
+            self.calls.append((model, texts))
+            leads = [{"name": t} for t in texts]
+            if self.drop_from_batch:
+                leads = leads[: -self.drop_from_batch]
+            return orjson.dumps({"leads": leads}).decode()
+        texts = _SINGLE_RE.findall(user)
+        self.calls.append((model, texts))
+        return orjson.dumps({"name": texts[0]}).decode()
+
+
+class LeadBatcherTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.fake = FakeOpenAI()
+        self.cache = dave_core.LLMCache()
+        for patcher in (
+            mock.patch.object(dave_core, "call_openai", self.fake),
+            mock.patch.object(dave_core, "llm_cache", self.cache),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.batcher = LeadBatcher(
+            window_seconds=0.05, max_leads=8, max_prompt_tokens=12000
+        )
+        self.batcher.start()
+
+    async def asyncTearDown(self):
+        await self.batcher.stop()
+
+    async def submit_all(self, *items):
+        results = await asyncio.gather(
+            *(self.batcher.submit(text, model=model) for text, model in items)
+        )
+        return [orjson.loads(r)["name"] for r in results]
+
+    async def test_concurrent_leads_share_one_call_in_order(self):
+        names = await self.submit_all(
+            ("alpha", "m"), ("beta", "m"), ("gamma", "m")
+        )
+        self.assertEqual(names, ["alpha", "beta", "gamma"])
+        self.assertEqual(self.fake.calls, [("m", ["alpha", "beta", "gamma"])])
+
+    async def test_count_mismatch_falls_back_to_single_calls(self):
+        self.fake.drop_from_batch = 1
+        names = await self.submit_all(("alpha", "m"), ("beta", "m"))
+        self.assertEqual(names, ["alpha", "beta"])
+        self.assertEqual(self.fake.calls[0], ("m", ["alpha", "beta"]))
+        self.assertCountEqual(
+            self.fake.calls[1:], [("m", ["alpha"]), ("m", ["beta"])]
+        )
+
+    async def test_api_error_fails_the_whole_batch_without_single_calls(self):
+        self.fake.error = RuntimeError("429 after retries")
+        results = await asyncio.gather(
+            self.batcher.submit("alpha", model="m"),
+            self.batcher.submit("beta", model="m"),
+            return_exceptions=True,
+        )
+        self.assertEqual(results, [self.fake.error, self.fake.error])
+        self.assertEqual(self.fake.calls, [("m", None)])
+
+    async def test_duplicate_leads_in_a_window_are_sent_once(self):
+        names = await self.submit_all(("alpha", "m"), ("beta", "m"), ("alpha", "m"))
+        self.assertEqual(names, ["alpha", "beta", "alpha"])
+        self.assertEqual(self.fake.calls, [("m", ["alpha", "beta"])])
+
+    async def test_batched_leads_are_cached_under_the_single_lead_key(self):
+        await self.submit_all(("alpha", "m"), ("beta", "m"))
+        cached = await self.cache.get(
+            "m",
+            dave_core.build_lead_messages("beta"),
+            LeadBatcher.temperature,
+            dave_core.LEAD_RESPONSE_FORMAT,
+        )
+        self.assertEqual(orjson.loads(cached), {"name": "beta"})
+
+        # A repeat skips the queue and the API entirely
+        self.assertEqual(await self.submit_all(("beta", "m")), ["beta"])
+        self.assertEqual(len(self.fake.calls), 1)
+
+    async def test_models_are_batched_separately(self):
+        names = await self.submit_all(
+            ("alpha", "mini"), ("beta", "mini"), ("gamma", "big"), ("delta", "big")
+        )
+        self.assertEqual(names, ["alpha", "beta", "gamma", "delta"])
+        self.assertCountEqual(
+            self.fake.calls,
+            [("mini", ["alpha", "beta"]), ("big", ["gamma", "delta"])],
+        )
+
+    async def test_max_leads_splits_a_burst(self):
+        self.batcher.max_leads = 2
+        names = await self.submit_all(("a1", "m"), ("a2", "m"), ("a3", "m"))
+        self.assertEqual(names, ["a1", "a2", "a3"])
+        self.assertEqual(
+            self.fake.calls, [("m", ["a1", "a2"]), ("m", ["a3"])]
+        )
+
+    async def test_crashed_loop_fails_pending_leads_then_calls_directly(self):
+        real_estimate = dave_core.estimate_tokens
+        seen = []
+
+        def flaky_estimate(text):
+            seen.append(text)
+            if len(seen) == 2:
+                raise RuntimeError("boom")
+            return real_estimate(text)
+
+        with mock.patch.object(dave_core, "estimate_tokens", flaky_estimate):
+            results = await asyncio.gather(
+                self.batcher.submit("alpha", model="m"),
+                self.batcher.submit("beta", model="m"),
+                self.batcher.submit("gamma", model="m"),
+                return_exceptions=True,
+            )
+        self.assertTrue(all(isinstance(r, RuntimeError) for r in results))
+
+        # With the loop gone, submit() makes the single call itself
+        self.assertIsNone(self.batcher._task)
+        content = await self.batcher.submit("delta", model="m")
+        self.assertEqual(orjson.loads(content)["name"], "delta")
+
+
+if __name__ == "__main__":
+    unittest.main()
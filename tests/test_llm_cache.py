@@ -0,0 +1,146 @@
+import os
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import dave_core  # noqa: E402
+from dave_core import LLMCache  # noqa: E402
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeDisk:
+    """The slice of diskcache.Cache that LLMCache uses."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, expire=None):
+        self.data[key] = value
+
+
+class LLMCacheTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch.object(
+            dave_core, "time", SimpleNamespace(monotonic=self.clock.monotonic)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_hit_within_ttl(self):
+        cache = LLMCache(ttl_seconds=60)
+        await cache.set("m", MESSAGES, 0.2, "content")
+        self.clock.now += 59
+        self.assertEqual(await cache.get("m", MESSAGES, 0.2), "content")
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    async def test_entry_expires_after_ttl(self):
+        cache = LLMCache(ttl_seconds=60)
+        await cache.set("m", MESSAGES, 0.2, "content")
+        self.clock.now += 60
+        self.assertIsNone(await cache.get("m", MESSAGES, 0.2))
+        self.assertEqual(cache.stats()["size"], 0)
+
+    async def test_least_recently_used_entry_is_evicted(self):
+        cache = LLMCache(max_entries=2)
+        a, b, c = ([{"role": "user", "content": t}] for t in "abc")
+        await cache.set("m", a, 0.2, "A")
+        await cache.set("m", b, 0.2, "B")
+        # Touch "a" so "b" is the oldest
+        await cache.get("m", a, 0.2)
+        await cache.set("m", c, 0.2, "C")
+        self.assertIsNone(await cache.get("m", b, 0.2))
+        self.assertEqual(await cache.get("m", a, 0.2), "A")
+        self.assertEqual(cache.stats()["size"], 2)
+
+    async def test_key_covers_model_temperature_and_response_format(self):
+        cache = LLMCache()
+        await cache.set("m", MESSAGES, 0.2, "content")
+        self.assertIsNone(await cache.get("other", MESSAGES, 0.2))
+        self.assertIsNone(await cache.get("m", MESSAGES, 0.0))
+        self.assertIsNone(
+            await cache.get("m", MESSAGES, 0.2, {"type": "json_object"})
+        )
+
+    async def test_disk_tier_refills_memory(self):
+        disk = FakeDisk()
+        await LLMCache(disk=disk).set("m", MESSAGES, 0.2, "content")
+        fresh = LLMCache(disk=disk)
+        self.assertEqual(await fresh.get("m", MESSAGES, 0.2), "content")
+        self.assertEqual(await fresh.get("m", MESSAGES, 0.2), "content")
+        self.assertEqual(fresh.stats()["disk_hits"], 1)
+        self.assertEqual(fresh.stats()["hits"], 1)
+
+
+def _chunk(content=None, finish_reason=None):
+    delta = SimpleNamespace(content=content)
+    choice = SimpleNamespace(delta=delta, finish_reason=finish_reason)
+    return SimpleNamespace(choices=[choice], usage=None)
+
+
+class FakeStream:
+    def __init__(self, content, finish_reason):
+        self.chunks = [_chunk(content), _chunk(finish_reason=finish_reason)]
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+class CallOpenAICachingTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.responses = []
+        self.calls = 0
+
+        async def create(**kwargs):
+            self.calls += 1
+            return FakeStream(*self.responses.pop(0))
+
+        patches = [
+            mock.patch.object(dave_core, "llm_cache", LLMCache()),
+            mock.patch.object(dave_core.client.chat.completions, "create", create),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    async def call(self):
+        return await dave_core.call_openai(
+            MESSAGES, response_format=dave_core.LEAD_RESPONSE_FORMAT
+        )
+
+    async def test_valid_completion_is_cached(self):
+        self.responses = [('{"name": "Jane"}', "stop")]
+        await self.call()
+        self.assertEqual(await self.call(), '{"name": "Jane"}')
+        self.assertEqual(self.calls, 1)
+
+    async def test_unparseable_completion_is_not_cached(self):
+        self.responses = [('{"name": "Ja', "stop"), ('{"name": "Jane"}', "stop")]
+        self.assertEqual(await self.call(), '{"name": "Ja')
+        self.assertEqual(await self.call(), '{"name": "Jane"}')
+        self.assertEqual(self.calls, 2)
+
+    async def test_truncated_completion_is_not_cached(self):
+        self.responses = [('{"name": "Jane"}', "length"), ('{"name": "Jane"}', "stop")]
+        await self.call()
+        await self.call()
+        self.assertEqual(self.calls, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
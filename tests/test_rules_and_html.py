@@ -0,0 +1,83 @@
+import os
+import unittest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import dave_core  # noqa: E402
+from dave_core import build_reply_html_from_result, try_rules_based_result  # noqa: E402
+
+FORM = {
+    "form_name": "  Home   Evaluation ",
+    "from_name": "José “J” Alvarez",
+    "from_email": "jose@example.com",
+    "phone": "604-555-0100",
+}
+
+
+class ReplyHtmlTests(unittest.TestCase):
+    def test_paragraphs_and_line_breaks(self):
+        html = build_reply_html_from_result({"reply": "Hi Sam,\n\nLine one\nLine two"})
+        self.assertTrue(
+            html.startswith("<p>Hi Sam,</p><p>Line one<br>Line two</p>\n")
+        )
+        self.assertTrue(html.endswith(dave_core.SIGNATURE_HTML))
+
+    def test_reply_text_is_escaped(self):
+        reply = 'Hi <script>alert(1)</script>,\n\nSee "A & B" <a href=x>here</a>'
+        html = build_reply_html_from_result({"reply": reply})
+        self.assertNotIn("<script>", html)
+        self.assertNotIn("<a href=x>", html)
+        self.assertIn("Hi &lt;script&gt;alert(1)&lt;/script&gt;,", html)
+        self.assertIn("&quot;A &amp; B&quot;", html)
+
+    def test_empty_reply_uses_the_default_body(self):
+        for result in ({}, {"reply": ""}, {"reply": "\n\n  \n\n"}):
+            with self.subTest(result=result):
+                self.assertTrue(
+                    build_reply_html_from_result(result).startswith(
+                        dave_core.DEFAULT_BODY_HTML
+                    )
+                )
+
+
+class RulesBasedResultTests(unittest.TestCase):
+    def test_known_form_is_answered_without_gpt(self):
+        result = try_rules_based_result(FORM, "New valuation", "3 bed in Coquitlam")
+        self.assertEqual(
+            {k: result[k] for k in ("name", "email", "phone", "lead_type", "priority")},
+            {
+                "name": 'José "J" Alvarez',
+                "email": "jose@example.com",
+                "phone": "604-555-0100",
+                "lead_type": "Home Evaluation",
+                "priority": "High",
+            },
+        )
+        self.assertEqual(result["summary"], "New valuation: 3 bed in Coquitlam")
+        self.assertTrue(result["reply"].startswith("Hi José,\n\n"))
+
+    def test_missing_name_greets_generically(self):
+        form = {**FORM, "from_name": "  "}
+        result = try_rules_based_result(form, "", "body")
+        self.assertIsNone(result["name"])
+        self.assertEqual(result["summary"], "body")
+        self.assertTrue(result["reply"].startswith("Hi there,\n\n"))
+
+    def test_unknown_form_or_no_reply_address_falls_through(self):
+        rental = {**FORM, "form_name": "Rental"}
+        self.assertIsNone(try_rules_based_result(rental, "", ""))
+        self.assertIsNone(try_rules_based_result({**FORM, "from_email": ""}, "", ""))
+        self.assertIsNone(try_rules_based_result({}, "", ""))
+
+    def test_summary_is_capped(self):
+        result = try_rules_based_result(FORM, "S", "x" * 1000)
+        self.assertEqual(len(result["summary"]), 500)
+
+    def test_sender_name_is_escaped_in_the_html(self):
+        form = {**FORM, "from_name": "<b>Eve</b> Smith"}
+        html = build_reply_html_from_result(try_rules_based_result(form, "", ""))
+        self.assertIn("Hi &lt;b&gt;Eve&lt;/b&gt;,", html)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import unittest
+from unittest import mock
+
+import orjson
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import dave_core  # noqa: E402
+from dave_core import _result_from_semantic_entry, _semantic_entry  # noqa: E402
+
+ALICE = {
+    "name": "Alice Smith",
+    "email": "alice@x.com",
+    "phone": "604-555-0001",
+    "lead_type": "Seller",
+    "priority": "High",
+    "summary": "Alice wants to sell 12 Oak St, pre-approved to $900k.",
+    "reply": "Hi Alice,\n\nThanks for reaching out about selling.\n\nCheers, David",
+}
+
+
+class FakeSemanticCache:
+    """Treats every lookup after the first store as a paraphrase hit."""
+
+    def __init__(self):
+        self.stored = []
+        self.vectors = []
+
+    async def acheck(self, prompt=None, vector=None, num_results=1):
+        self.vectors.append(vector)
+        return [{"response": self.stored[-1]}] if self.stored else []
+
+    async def astore(self, prompt, response, vector=None):
+        self.vectors.append(vector)
+        self.stored.append(response)
+
+
+class SemanticEntryTests(unittest.TestCase):
+    def test_keeps_only_classification_and_reply_body(self):
+        self.assertEqual(
+            _semantic_entry(ALICE),
+            {
+                "lead_type": "Seller",
+                "priority": "High",
+                "reply_body": "Thanks for reaching out about selling.\n\nCheers, David",
+            },
+        )
+
+    def test_reply_body_naming_the_sender_is_not_cached(self):
+        for reply in (
+            "Hi Alice,\n\nAlice, does Tuesday work?",
+            "Hi there,\n\nI'll write to alice@x.com.",
+            "Hi there,\n\nI'll call 604-555-0001 tomorrow.",
+        ):
+            with self.subTest(reply=reply):
+                self.assertIsNone(_semantic_entry({**ALICE, "reply": reply}))
+
+    def test_greeting_only_reply_is_not_cached(self):
+        self.assertIsNone(_semantic_entry({**ALICE, "reply": "Hi Alice,\n\n"}))
+
+    def test_rebuild_uses_the_current_email(self):
+        result = _result_from_semantic_entry(
+            _semantic_entry(ALICE),
+            ("bob@y.com", "778-555-0002"),
+            "Selling my home in Coquitlam",
+            sender_name="Bob Lee",
+        )
+        self.assertEqual(result["email"], "bob@y.com")
+        self.assertEqual(result["phone"], "778-555-0002")
+        self.assertIsNone(result["name"])
+        self.assertEqual(result["summary"], "Selling my home in Coquitlam")
+        self.assertTrue(result["reply"].startswith("Hi Bob,\n\n"))
+        self.assertEqual(result["cache"], "semantic_hit")
+
+    def test_rebuild_without_a_name_greets_generically(self):
+        result = _result_from_semantic_entry(
+            _semantic_entry(ALICE), (None, None), "preview"
+        )
+        self.assertTrue(result["reply"].startswith("Hi there,\n\n"))
+
+
+class SemanticHitTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.cache = FakeSemanticCache()
+        self.submit = mock.AsyncMock(return_value=orjson.dumps(ALICE).decode())
+        self.embed = mock.AsyncMock(return_value=[1.0, 0.0])
+        patches = [
+            mock.patch.object(dave_core, "embed_text", self.embed),
+            mock.patch.object(dave_core, "semantic_cache", self.cache),
+            mock.patch.object(dave_core.lead_batcher, "submit", self.submit),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    async def test_miss_embeds_once_for_check_and_store(self):
+        await dave_core.handle_gmail_lead_reply("Sell 12 Oak St. " + "x" * 3000)
+
+        self.embed.assert_awaited_once()
+        self.assertEqual(len(self.embed.await_args.args[0]), 2000)
+        self.assertEqual(self.cache.vectors, [[1.0, 0.0], [1.0, 0.0]])
+
+    async def test_paraphrase_from_another_sender_carries_none_of_the_first(self):
+        await dave_core.handle_gmail_lead_reply(
+            "Sell 12 Oak St. Alice Smith alice@x.com 604-555-0001",
+            sender_name="Alice Smith",
+        )
+        bob_email = "Selling my place. Bob Lee bob@y.com 778-555-0002"
+        result = await dave_core.handle_gmail_lead_reply(
+            bob_email, sender_name="Bob Lee"
+        )
+
+        self.assertEqual(self.submit.await_count, 1)
+        self.assertEqual(result["cache"], "semantic_hit")
+        self.assertEqual(result["summary"], bob_email)
+        self.assertEqual(
+            (result["email"], result["phone"]), ("bob@y.com", "778-555-0002")
+        )
+        dumped = orjson.dumps(result).decode()
+        for leaked in ("Alice", "alice@x.com", "604-555-0001", "Oak", "900k"):
+            self.assertNotIn(leaked, dumped)
+
+
+class LocalSemanticCacheTests(unittest.IsolatedAsyncioTestCase):
+    async def test_given_vector_skips_embedding(self):
+        cache = dave_core.LocalSemanticCache(max_entries=4)
+        with mock.patch.object(dave_core, "embed_text") as embed:
+            await cache.astore("a", "cached", vector=[3.0, 4.0])
+            hit = await cache.acheck("b", vector=[0.6, 0.8])
+            miss = await cache.acheck("c", vector=[0.8, -0.6])
+        embed.assert_not_called()
+        self.assertEqual(hit[0]["response"], "cached")
+        self.assertEqual(miss, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
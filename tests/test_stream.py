@@ -0,0 +1,98 @@
+import os
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import app  # noqa: E402
+import dave_core  # noqa: E402
+from app import sse_frame  # noqa: E402
+
+
+def _chunk(content):
+    delta = SimpleNamespace(content=content)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)], usage=None)
+
+
+class FakeStream:
+    def __init__(self, tokens, error=None):
+        self.tokens = tokens
+        self.error = error
+
+    async def __aiter__(self):
+        for token in self.tokens:
+            yield _chunk(token)
+        if self.error is not None:
+            raise self.error
+
+
+class SseFrameTests(unittest.TestCase):
+    def test_single_line(self):
+        self.assertEqual(sse_frame("hi"), "data: hi\n\n")
+
+    def test_newlines_become_data_lines(self):
+        self.assertEqual(sse_frame("a\n\nb"), "data: a\ndata: \ndata: b\n\n")
+
+    def test_named_event(self):
+        self.assertEqual(
+            sse_frame("oops", event="error"), "event: error\ndata: oops\n\n"
+        )
+
+
+class StreamEndpointTests(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.stream = FakeStream(["Hi ", "Sam,\n\n", "Cheers"])
+        self.create = mock.AsyncMock(side_effect=lambda **kwargs: self.stream)
+        patches = [
+            mock.patch.object(app, "_AUTH_ENABLED", False),
+            mock.patch.object(
+                dave_core.client.chat.completions, "create", self.create
+            ),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+        self.client = app.app.test_client()
+
+    async def post(self, payload):
+        response = await self.client.post("/stream", json=payload)
+        return response, (await response.get_data()).decode()
+
+    async def test_tokens_stream_as_frames_then_done(self):
+        response, body = await self.post({"body": "Can we see the house Sunday?"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/event-stream")
+        self.assertEqual(
+            body,
+            "data: Hi \n\n"
+            "data: Sam,\ndata: \ndata: \n\n"
+            "data: Cheers\n\n"
+            "data: [DONE]\n\n",
+        )
+        model = self.create.await_args.kwargs["model"]
+        self.assertEqual(model, dave_core.HANDLER_MODEL)
+
+    async def test_failure_mid_stream_ends_with_an_error_event(self):
+        self.stream = FakeStream(["Hi "], error=RuntimeError("connection reset"))
+        _, body = await self.post({"body": "Hello"})
+        self.assertEqual(
+            body,
+            "data: Hi \n\nevent: error\ndata: openai_error: connection reset\n\n",
+        )
+
+    async def test_slot_is_released_after_the_stream(self):
+        before = dave_core._openai_slots._value
+        await self.post({"body": "Hello"})
+        self.stream = FakeStream([], error=RuntimeError("boom"))
+        await self.post({"body": "Hello"})
+        self.assertEqual(dave_core._openai_slots._value, before)
+
+    async def test_lead_extraction_is_refused(self):
+        response, _ = await self.post({"body": "x", "task_type": "gmail_lead_reply"})
+        self.assertEqual(response.status_code, 400)
+        self.create.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
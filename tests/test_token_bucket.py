@@ -0,0 +1,84 @@
+import os
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+import dave_core  # noqa: E402
+from dave_core import TokenBucket  # noqa: E402
+
+
+class FakeClock:
+    """Stands in for time.monotonic; fake sleeps advance it."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class TokenBucketTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patches = [
+            mock.patch.object(
+                dave_core, "time", SimpleNamespace(monotonic=self.clock.monotonic)
+            ),
+            mock.patch.object(dave_core.asyncio, "sleep", self.clock.sleep),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    async def test_acquire_within_budget_does_not_wait(self):
+        bucket = TokenBucket(rpm=10, tpm=1000)
+        await bucket.acquire(100)
+        self.assertEqual(self.clock.slept, [])
+        self.assertAlmostEqual(bucket._requests, 9)
+        self.assertAlmostEqual(bucket._tokens, 900)
+
+    async def test_acquire_waits_for_tokens_to_refill(self):
+        bucket = TokenBucket(rpm=100, tpm=600)  # 10 tokens/second
+        await bucket.acquire(600)
+        await bucket.acquire(100)
+        self.assertAlmostEqual(sum(self.clock.slept), 10, places=1)
+
+    async def test_acquire_waits_for_request_budget(self):
+        bucket = TokenBucket(rpm=1, tpm=1000)
+        await bucket.acquire(1)
+        await bucket.acquire(1)
+        self.assertAlmostEqual(sum(self.clock.slept), 60, places=1)
+
+    async def test_estimate_above_tpm_is_clamped_instead_of_waiting_forever(self):
+        bucket = TokenBucket(rpm=10, tpm=1000)
+        await bucket.acquire(5000)
+        self.assertEqual(self.clock.slept, [])
+        self.assertAlmostEqual(bucket._tokens, 0)
+
+    async def test_release_extra_refunds_overestimates_up_to_tpm(self):
+        bucket = TokenBucket(rpm=10, tpm=1000)
+        await bucket.acquire(500)
+        bucket.release_extra(-300)
+        self.assertAlmostEqual(bucket._tokens, 800)
+        bucket.release_extra(-10_000)
+        self.assertAlmostEqual(bucket._tokens, 1000)
+
+    async def test_release_extra_charges_underestimates(self):
+        bucket = TokenBucket(rpm=10, tpm=600)  # 10 tokens/second
+        await bucket.acquire(500)
+        bucket.release_extra(400)
+        self.assertAlmostEqual(bucket._tokens, -300)
+        # The debt has to refill before the next call fits
+        await bucket.acquire(100)
+        self.assertAlmostEqual(sum(self.clock.slept), 40, places=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import unittest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+from dave_core import trim_email  # noqa: E402
+
+
+class TrimEmailTests(unittest.TestCase):
+    def test_strips_quoted_reply_and_forward_noise(self):
+        text = (
+            "Hi David,\n\nWe'd like to list our townhouse.\n\n"
+            "On Mon, Oct 6, 2025 at 9:12 AM David <d@example.com> wrote:\n"
+            "> Thanks for reaching out\n"
+            ">\n"
+            "---------- Forwarded message ---------\n"
+            "From: Jane <jane@example.com>"
+        )
+        self.assertEqual(
+            trim_email(text),
+            "Hi David,\n\nWe'd like to list our townhouse.\n\n"
+            "From: Jane <jane@example.com>",
+        )
+
+    def test_all_quoted_email_is_kept(self):
+        self.assertEqual(trim_email("> only quoted"), "> only quoted")
+
+    def test_long_email_keeps_head_and_tail(self):
+        text = "h" * 600 + "t" * 600
+        trimmed = trim_email(text, max_chars=417)
+        self.assertEqual(trimmed, "h" * 300 + "\n...[trimmed]...\n" + "t" * 100)
+
+    def test_result_never_exceeds_max_chars(self):
+        text = "h" * 600 + "t" * 600
+        for max_chars in (1, 10, 17, 18, 19, 100, 1199):
+            with self.subTest(max_chars=max_chars):
+                self.assertLessEqual(len(trim_email(text, max_chars)), max_chars)
+
+    def test_limit_below_marker_length_is_a_plain_cut(self):
+        self.assertEqual(trim_email("x" * 20, max_chars=3), "xxx")
+
+
+if __name__ == "__main__":
+    unittest.main()